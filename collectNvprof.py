@@ -9,6 +9,7 @@ import os
 import re
 
 from processCsvData import *
+from predictRuntime import *
 
 nvMetricNames = ["flop_count_dp",
                  "flop_count_sp",
@@ -229,11 +230,70 @@ def FormatUnits(value, baseTwo=False, baseUnit=''):
 
     return "{:.3f}Y{}".format(value, prefix, baseUnit)
 
-def ProfileApp(command):
+def selectKernels(kernelMetrics, coverage=None, timeBudget=None):
+    """
+    Ranks kernels by their total duration and picks the smallest set
+    that covers the given share of GPU time (ie 0.95) and/or fits in the
+    given time budget in seconds. The budget limits the summed GPU time of
+    the selected kernels in one run of the application, ie the kernel time
+    each metric pass replays, not the wall time of profiling
+    The longest kernel is always selected
+    Library calls (names starting with [) are never selected or skipped
+    Returns a list of selected kernels and a dict of skipped kernels with
+    their total duration
+    """
+
+    kernelTimes = dict()
+    for kernel in kernelMetrics:
+        if kernel[0] == "[" or "Duration" not in kernelMetrics[kernel]:
+            continue
+        kernelTimes[kernel] = sum(kernelMetrics[kernel]["Duration"])
+
+    totalTime = sum(kernelTimes.values())
+    selected = []
+    skipped = dict()
+    selectedTime = 0
+    for kernel in sorted(kernelTimes, key=kernelTimes.get, reverse=True):
+        covered = coverage is not None and selectedTime >= coverage * totalTime
+        overBudget = timeBudget is not None and selectedTime + kernelTimes[kernel] > timeBudget
+        if len(selected) > 0 and (covered or overBudget):
+            skipped[kernel] = kernelTimes[kernel]
+            continue
+        selected.append(kernel)
+        selectedTime = selectedTime + kernelTimes[kernel]
+
+    if timeBudget is not None and selectedTime > timeBudget:
+        logging.warning("Longest kernel {} takes {} s, over the time budget of {} s".format(selected[0], selectedTime, timeBudget))
+
+    logging.info("Selected {} kernels covering {} s of {} s GPU time, skipped {} kernels".format(len(selected),
+                 selectedTime, totalTime, len(skipped)))
+    return selected, skipped
+
+def kernelFilter(kernels):
+    """
+    Builds an nvprof --kernels filter that matches the given kernels
+    The name is a regex made from the demangled name without its parameters
+    or return type, colons separate the parts of the filter and spaces are
+    escaped differently between regex flavors so both are replaced with a wildcard
+    """
+
+    names = []
+    for kernel in kernels:
+        name = str.split(kernel, '(')[0]
+        if name.startswith("void "):
+            name = name[len("void "):]
+        names.append(re.escape(name).replace("\\ ", ".").replace(":", "."))
+    return "::{}:".format("|".join(names))
+
+def ProfileApp(command, coverage=None, timeBudget=None, skippedKernels=None):
     """
     Profiles a given cuda application using the command provided
     The profile data is returned as a dict of kernels with their metrics
     and the data for each call
+
+    If coverage or timeBudget is given only the kernels selected by
+    selectKernels are replayed for the metric passes, skipped kernels and
+    their total duration are added to skippedKernels if provided
     """
 
     logging.info("Command to profile: {0}".format(" ".join(command)))
@@ -261,12 +321,26 @@ def ProfileApp(command):
     # take our output and store it in our dictionary of metrics
     processNvprofCSV(std_err.decode().splitlines(), kernelMetrics)
 
+    # only replay the kernels that matter for the metric passes
+    selected = None
+    if coverage is not None or timeBudget is not None:
+        selected, skipped = selectKernels(kernelMetrics, coverage, timeBudget)
+        if skippedKernels is not None:
+            skippedKernels.update(skipped)
+
+        if len(selected) == 0:
+            logging.warning("No kernels selected for profiling, skipping the metric passes")
+            return kernelMetrics
+
     for metric in nvMetricNames:
         std_out = ""
         std_err = ""
 
         # build the profiling command
-        profileCommand = ["nvprof", "--metrics", metric, "--print-gpu-trace", "--csv"]
+        profileCommand = ["nvprof"]
+        if selected is not None:
+            profileCommand.extend(["--kernels", kernelFilter(selected)])
+        profileCommand.extend(["--metrics", metric, "--print-gpu-trace", "--csv"])
         profileCommand.extend(command)
 
         logging.info("nvprof command: {0}".format(" ".join(profileCommand)))
@@ -280,7 +354,29 @@ def ProfileApp(command):
             exit(1)
 
         # take our output and store it in our dictionary of metrics
-        processNvprofCSV(std_err.decode().splitlines(), kernelMetrics)
+        if selected is None:
+            processNvprofCSV(std_err.decode().splitlines(), kernelMetrics)
+            continue
+
+        # the filter is a regex so make sure only the selected
+        # kernels are kept, call counts come from the trace pass
+        passMetrics = processNvprofCSV(std_err.decode().splitlines(), dict())
+        for kernel in passMetrics:
+            if kernel not in selected:
+                continue
+            for key in passMetrics[kernel]:
+                if key == "callCount":
+                    continue
+                if key not in kernelMetrics[kernel]:
+                    kernelMetrics[kernel][key] = []
+                kernelMetrics[kernel][key].extend(passMetrics[kernel][key])
+
+    # the filter may not have matched every kernel the way nvprof names it
+    if selected is not None:
+        for kernel in selected:
+            if not any(metric in kernelMetrics[kernel] for metric in nvMetricNames):
+                logging.warning("No metrics collected for selected kernel {}, the kernel filter "
+                                "{} didn't match it".format(kernel, kernelFilter([kernel])))
 
     return kernelMetrics
 
@@ -406,10 +502,12 @@ def generateRooflinePoints(kernelMetrics):
 
     return rooflines, memRooflines
 
-def generateAspenModel(kernelMetrics, modelName=None, rooflines=None):
+def generateAspenModel(kernelMetrics, modelName=None, rooflines=None, skippedKernels=None, outputDir=None):
     """
     Generates and aspen model based on kernel metrics
     counts will be based on profile data
+    kernels skipped during profiling are noted in the model along with their time
+    the model is written to the current directory unless an output directory is given
     """
 
     # metrics we care about and the mapping to aspen resources
@@ -431,12 +529,19 @@ def generateAspenModel(kernelMetrics, modelName=None, rooflines=None):
 
     indent = 0
     modelFileName = modelName + ".aspen"
+    if outputDir is not None:
+        modelFileName = os.path.join(outputDir, modelFileName)
 
     with open(modelFileName, 'w') as aspenFile:
         # boilerplate
         aspenFile.write("// Aspen file generated automatically using cuda roofline tool\n")
         aspenFile.write("// All kernels have exact counts from profiling\n")
         aspenFile.write("// This model needs to know the number of processors to run on\n")
+        if skippedKernels:
+            aspenFile.write("// {} kernels were not profiled, they have no counts and take {} s in total\n".format(
+                  len(skippedKernels), sum(skippedKernels.values())))
+            for kernel in skippedKernels:
+                aspenFile.write("// skipped kernel {} total exec time {}\n".format(formatKernel(kernel), skippedKernels[kernel]))
         aspenFile.write("\n\n")
 
         aspenFile.write("model {} {{\n".format(modelName))
@@ -460,6 +565,9 @@ def generateAspenModel(kernelMetrics, modelName=None, rooflines=None):
                         aspenFile.write("{}// {} flops/byte {}  gflops\n".format("\t" * indent,
                            rooflines[roofline][0], rooflines[roofline][1] / 1.0e09))
 
+            if skippedKernels and kernel in skippedKernels:
+                aspenFile.write("{}// skipped during profiling, no counts\n".format("\t" * indent))
+
             aspenFile.write("{}kernel {} {{\n".format("\t" * indent, formatKernel(kernel)))
             indent = indent + 1
 
@@ -504,8 +612,20 @@ def generateAspenModel(kernelMetrics, modelName=None, rooflines=None):
         # end of the model
         aspenFile.write("}\n")
 
-def generateRooflinesCSV(rooflines, memRooflines, kernelMetrics, modelName):
+def writeSkippedNote(csvfile, skippedKernels):
+    """
+    Notes the kernels skipped during profiling at the top of a roofline csv
+    file, these are comments so gnuplot ignores them
+    """
+
+    csvfile.write("# {} kernels were not profiled and have no roofline points, {} s in total\n".format(
+                  len(skippedKernels), sum(skippedKernels.values())))
+    for kernel in skippedKernels:
+        csvfile.write("# skipped kernel {} total exec time {}\n".format(formatKernel(kernel), skippedKernels[kernel]))
+
+def generateRooflinesCSV(rooflines, memRooflines, kernelMetrics, modelName, skippedKernels=None):
     logging.info("writing out roofline files")
+    notedFiles = set()
     for kernel in kernelMetrics:
         for roofline in rooflines:
             if kernel in roofline:
@@ -518,6 +638,9 @@ def generateRooflinesCSV(rooflines, memRooflines, kernelMetrics, modelName):
                 print("Final name {}".format(csvFileName))
 
                 with open(csvFileName, 'a', newline='') as csvfile:
+                    if skippedKernels and csvFileName not in notedFiles:
+                        writeSkippedNote(csvfile, skippedKernels)
+                        notedFiles.add(csvFileName)
                     csvfile.write("{},{},{},{},{}\n".format(rooflines[roofline][0], rooflines[roofline][1] / 1.0e9,
                                                             rooflines[roofline][2], rooflines[roofline][2] / 1.0e9,
                                                             roofline.split("/")[0].replace("_", " " )))
@@ -525,45 +648,147 @@ def generateRooflinesCSV(rooflines, memRooflines, kernelMetrics, modelName):
             if kernel in memRoofline:
                 csvFileName = modelName + "_" + formatKernel(kernel, stripTypes=True, moveEnd=True) + "_mem.csv"
                 with open(csvFileName, 'a', newline='') as csvfile:
+                    if skippedKernels and csvFileName not in notedFiles:
+                        writeSkippedNote(csvfile, skippedKernels)
+                        notedFiles.add(csvFileName)
                     csvfile.write("{},{},{},{},{}\n".format(memRooflines[memRoofline][0], memRooflines[memRoofline][1] / 1.0e9,
                                                             memRooflines[memRoofline][2], memRooflines[memRoofline][2] / 1.0e9,
                                                             memRoofline.split("/")[0].replace("_", " " )))
 
-logging.basicConfig(level=logging.INFO)
-
-if len(sys.argv) < 2:
-    print("Correct usage {0} <command to profile>".format(sys.argv[0]))
-    exit(0)
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    usage = ("Correct usage {0} [--cache <cache file>] [--predict <template>]... [--coverage <fraction>] "
+             "[--time-budget <seconds>] <command to profile>\n"
+             "          or {0} --submit <unix:socket path | [host:]port> <nvprof --csv log or --cache file>...\n"
+             "  --coverage     share of the GPU time the profiled kernels must cover, in (0, 1]\n"
+             "  --time-budget  limit on the summed GPU time of the profiled kernels in one run\n"
+             "                 of the application, not on the total profiling time".format(sys.argv[0]))
+
+    if len(sys.argv) < 2:
+        print(usage)
+        exit(0)
+
+    # client mode, send the profiles to a running profile service
+    # and write out its results
+    if sys.argv[1] == "--submit":
+        if len(sys.argv) < 4:
+            print(usage)
+            exit(0)
+        from profileService import submitProfile
+
+        for profileFileName in sys.argv[3:]:
+            modelName = os.path.splitext(os.path.basename(profileFileName))[0]
+            with open(profileFileName, 'rb') as profileFile:
+                result = submitProfile(sys.argv[2], profileFile, modelName)
+
+            with open(modelName + ".aspen", 'w') as aspenFile:
+                aspenFile.write(result["aspen"])
+            generateRooflinesCSV(result["rooflines"], result["memRooflines"], result["kernels"], modelName,
+                                 result["skippedKernels"])
+
+            print("Roofline points for {}".format(profileFileName))
+            for kernel in result["rooflines"]:
+                print("{}  {}  flops/byte  {}  flops/sec".format(kernel, result["rooflines"][kernel][0],
+                                                                 result["rooflines"][kernel][1]))
+        return
+
+    # optional binary cache of the parsed profile, if it already
+    # exists the profile is loaded from it instead of rerunning nvprof
+    # and optional templates of machines to predict runtimes for
+    # coverage and time budget only collect metrics for the kernels that matter
+    cacheFileName = None
+    templateFileNames = []
+    coverage = None
+    timeBudget = None
+    command = sys.argv[1:]
+    while len(command) > 0 and command[0] in ["--cache", "--predict", "--coverage", "--time-budget"]:
+        if len(command) < 2:
+            print(usage)
+            exit(0)
+        if command[0] == "--cache":
+            cacheFileName = command[1]
+        elif command[0] == "--predict":
+            templateFileNames.append(command[1])
+        else:
+            try:
+                value = float(command[1])
+            except ValueError:
+                print("{} needs a number, got {}".format(command[0], command[1]))
+                print(usage)
+                exit(1)
+            if command[0] == "--coverage":
+                if not 0 < value <= 1:
+                    print("--coverage must be in (0, 1], got {}".format(value))
+                    print(usage)
+                    exit(1)
+                coverage = value
+            else:
+                if value <= 0:
+                    print("--time-budget must be positive, got {}".format(value))
+                    print(usage)
+                    exit(1)
+                timeBudget = value
+        command = command[2:]
+
+    skippedKernels = dict()
+
+    if cacheFileName is not None and os.path.exists(cacheFileName):
+        # nothing is profiled, the cache may even be from another application
+        if coverage is not None or timeBudget is not None:
+            logging.warning("Cache {} already exists, --coverage and --time-budget are ignored".format(cacheFileName))
+        if len(command) > 0:
+            logging.warning("Cache {} already exists, {} is not profiled, the cached profile is used "
+                            "and named after it".format(cacheFileName, " ".join(command)))
+        kernelMetrics = loadNvprofCache(cacheFileName, skippedKernels)
+    elif len(command) == 0:
+        print(usage)
+        exit(0)
+    else:
+        kernelMetrics = ProfileApp(command, coverage, timeBudget, skippedKernels)
+        if cacheFileName is not None:
+            writeNvprofCache(kernelMetrics, cacheFileName, skippedKernels)
+
+    print("List of kernels")
+    for kernel in kernelMetrics:
+        print("{0}".format(kernel))
 
-command = sys.argv[1:]
+    #print("Kernel metrics")
+    #for kern in kernelMetrics:
+    #        print("{0} {1}".format(kern, list(kernelMetrics[kernel].keys())))
+    #        print("{0}".format(kernelMetrics[kern]))
 
-kernelMetrics = ProfileApp(command)
+    generateDerivedMetrics(kernelMetrics, statistics, throughputMetrics, countMetrics, combinedMetrics)
 
-print("List of kernels")
-for kernel in kernelMetrics:
-    print("{0}".format(kernel))
+    rooflines, memRooflines = generateRooflinePoints(kernelMetrics)
 
-#print("Kernel metrics")
-#for kern in kernelMetrics:
-#        print("{0} {1}".format(kern, list(kernelMetrics[kernel].keys())))
-#        print("{0}".format(kernelMetrics[kern]))
+    if len(command) > 0:
+        aspenModelName = os.path.basename(command[0])
+    else:
+        aspenModelName = os.path.splitext(os.path.basename(cacheFileName))[0]
+    generateAspenModel(kernelMetrics, aspenModelName, rooflines, skippedKernels)
 
-generateDerivedMetrics(kernelMetrics, statistics, throughputMetrics, countMetrics, combinedMetrics)
+    #for kernel in kernelMetrics:
 
-rooflines, memRooflines = generateRooflinePoints(kernelMetrics)
+    print("List of kernels")
+    for kernel in kernelMetrics:
+        print("{}".format(kernel))
 
-aspenModelName = os.path.basename(sys.argv[1])
-generateAspenModel(kernelMetrics, aspenModelName, rooflines)
 
-#for kernel in kernelMetrics:
+    generateRooflinesCSV(rooflines, memRooflines, kernelMetrics, aspenModelName, skippedKernels)
+    print("Roofline points")
+    for kernel in rooflines:
+        print("{}  {}  flops/byte  {}  flops/sec".format(kernel, rooflines[kernel][0], rooflines[kernel][1]))
 
-print("List of kernels")
-for kernel in kernelMetrics:
-    print("{}".format(kernel))
+    if len(skippedKernels) > 0:
+        print("Skipped kernels, {} s total".format(sum(skippedKernels.values())))
+        for kernel in skippedKernels:
+            print("{}  {} s".format(kernel, skippedKernels[kernel]))
 
+    if len(templateFileNames) > 0:
+        kernelPredictions, appPredictions, unmodeledKernels = predictRuntimes(kernelMetrics, loadMachines(templateFileNames))
+        printPredictions(kernelPredictions, appPredictions, unmodeledKernels, kernelMetrics)
 
-generateRooflinesCSV(rooflines, memRooflines, kernelMetrics, aspenModelName)
-print("Roofline points")
-for kernel in rooflines:
-    print("{}  {}  flops/byte  {}  flops/sec".format(kernel, rooflines[kernel][0], rooflines[kernel][1]))
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import re
+import os
+import logging
+import statistics
+
+
+# map of counts from generateDerivedMetrics to the template ceilings
+# that limit them, the first ceiling found in a template is used
+# half precision falls back to the single precision ceiling since
+# the templates don't have a half precision roof
+predictionResources = {"flop_count_dp" : ["dp_simd_fmad_flops", "dp_flops"],
+                       "flop_count_sp" : ["sp_simd_fmad_flops", "sp_flops"],
+                       "flop_count_hp" : ["hp_simd_fmad_flops", "hp_flops", "sp_simd_fmad_flops", "sp_flops"],
+                       "shared_bytes"  : ["shared_bw"],
+                       "l2_bytes"      : ["l2_bw"],
+                       "dram_bytes"    : ["mem_bw"]}
+
+# template ceilings are in GFLOPS and GB/s
+ceilingScale = 1.0e9
+
+def loadTemplateCeilings(templateFileName):
+    """
+    Reads the ceilings from a gnuplot roofline template
+    Bandwidth ceilings have the form  name(x) = x < ridge ? x * bandwidth : 1/0
+    and flops ceilings have the form  name(x) = x > ridge ? flops : 1/0
+    Returns a dict of ceiling names and their values in flops/sec or bytes/sec
+    """
+
+    ceilingRegex = re.compile(r'^\s*(\w+)\(x\)\s*=\s*x\s*([<>])\s*[-+.\deE]+\s*\?\s*(x\s*\*\s*)?([-+.\deE]+)\s*:')
+
+    ceilings = dict()
+    with open(templateFileName, 'r') as templateFile:
+        for line in templateFile:
+            match = ceilingRegex.match(line)
+            if match:
+                ceilings[match.group(1)] = float(match.group(4)) * ceilingScale
+                logging.debug("Ceiling {} {} in {}".format(match.group(1), ceilings[match.group(1)], templateFileName))
+
+    if len(ceilings) == 0:
+        raise ValueError("Error, no ceilings found in template {}".format(templateFileName))
+
+    return ceilings
+
+def loadMachines(templateFileNames):
+    """
+    Loads a list of templates, the machine name is the template file name
+    without the extension
+    Returns a dict of machine names and their ceilings
+    """
+
+    machines = dict()
+    for templateFileName in templateFileNames:
+        machineName = os.path.splitext(os.path.basename(templateFileName))[0]
+        machines[machineName] = loadTemplateCeilings(templateFileName)
+
+    return machines
+
+def predictRuntimes(kernelMetrics, machines):
+    """
+    Predicts the runtime of each kernel on each machine
+    kernelMetrics must already have its derived metrics (see generateDerivedMetrics)
+    Each kernel call takes as long as its slowest resource, which is reported
+    as the bounding resource. Kernels without any flops or byte counts (library
+    calls like memcpys and kernels skipped during profiling) can't be modeled,
+    their measured time is returned separately
+
+    Returns three dicts:
+    kernelPredictions[machine][kernel] = [time per call, total time, bounding resource]
+    appPredictions[machine]            = total time of all modeled kernels
+    unmodeledKernels[kernel]           = measured total time of a kernel that can't be modeled
+    """
+
+    resources = list(predictionResources.keys())
+    machineNames = list(machines.keys())
+
+    # demand per call for every kernel x resource
+    kernels = []
+    demands = []
+    callCounts = []
+    unmodeledKernels = dict()
+    for kernel in kernelMetrics:
+        demand = [statistics.mean(kernelMetrics[kernel][resource])
+                  if resource in kernelMetrics[kernel] and len(kernelMetrics[kernel][resource]) > 0 else 0
+                  for resource in resources]
+        if not any(demand):
+            logging.debug("No flops or bytes for kernel {}, skipping prediction".format(kernel))
+            unmodeledKernels[kernel] = sum(kernelMetrics[kernel].get("Duration", []))
+            continue
+        kernels.append(kernel)
+        demands.append(demand)
+        callCounts.append(kernelMetrics[kernel]["callCount"])
+
+    # inverse rate for every machine x resource, 0 if the machine has no ceiling
+    inverseRates = []
+    for machineName in machineNames:
+        inverseRate = []
+        for resource in resources:
+            ceilings = [machines[machineName][ceiling] for ceiling in predictionResources[resource]
+                        if ceiling in machines[machineName] and machines[machineName][ceiling] > 0]
+            if len(ceilings) == 0:
+                logging.info("Machine {} has no ceiling for {}, it will be ignored".format(machineName, resource))
+                inverseRate.append(0)
+            else:
+                inverseRate.append(1.0 / ceilings[0])
+        inverseRates.append(inverseRate)
+
+    # all kernels x all machines in one pass, a call takes as long
+    # as its slowest resource
+    kernelPredictions = dict()
+    appPredictions = dict()
+    for machineName, inverseRate in zip(machineNames, inverseRates):
+        kernelPredictions[machineName] = dict()
+        appTime = 0
+        for kernel, demand, callCount in zip(kernels, demands, callCounts):
+            times = [count * rate for count, rate in zip(demand, inverseRate)]
+            bound = max(range(len(resources)), key=times.__getitem__)
+            kernelPredictions[machineName][kernel] = [times[bound], times[bound] * callCount, resources[bound]]
+            appTime = appTime + times[bound] * callCount
+        appPredictions[machineName] = appTime
+
+    return kernelPredictions, appPredictions, unmodeledKernels
+
+def printPredictions(kernelPredictions, appPredictions, unmodeledKernels, kernelMetrics):
+    """
+    Prints predicted kernel and application times next to the measured times
+    Predictions only cover the modeled kernels so they're compared to the
+    measured time of those kernels, the measured time of the unmodeled kernels
+    is added unchanged to give the application total
+    """
+
+    measuredTime = 0
+    for kernel in kernelMetrics:
+        if kernel not in unmodeledKernels and "Duration" in kernelMetrics[kernel]:
+            measuredTime = measuredTime + sum(kernelMetrics[kernel]["Duration"])
+    unmodeledTime = sum(unmodeledKernels.values())
+
+    print("Predicted runtimes of modeled kernels, measured {} s".format(measuredTime))
+    print("Unmodeled kernels (library calls and skipped kernels), measured {} s".format(unmodeledTime))
+    for kernel in unmodeledKernels:
+        print("    {}  {} s".format(kernel, unmodeledKernels[kernel]))
+    for machineName in appPredictions:
+        print("{}  {} s modeled kernels  {} s with unmodeled kernels".format(machineName, appPredictions[machineName],
+              appPredictions[machineName] + unmodeledTime))
+        for kernel in kernelPredictions[machineName]:
+            timePerCall, totalTime, bound = kernelPredictions[machineName][kernel]
+            print("    {}  {} s/call  {} s  bound by {}".format(kernel, timePerCall, totalTime, bound))
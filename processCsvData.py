@@ -2,14 +2,34 @@ import csv
 import re
 import logging
 import subprocess
+import struct
+import array
+import mmap
+import sys
 
 
+# names that have already been demangled in this process, the
+# profile service also sets a cache shared between its workers
+# which is only used when the local cache misses
+demangleCache = dict()
+sharedDemangleCache = None
+
 def demangle(name):
     """ 
     demangles function names, uses the demangle program
     rather than a demangle module since it isn't accessible on 
     some systems
     """
+    demangledName = demangleCache.get(name)
+    if demangledName is not None:
+        return demangledName
+
+    if sharedDemangleCache is not None:
+        demangledName = sharedDemangleCache.get(name)
+        if demangledName is not None:
+            demangleCache[name] = demangledName
+            return demangledName
+
     command = ['c++filt']
     command.append( name )
     logging.debug(":processCsv:demangle c++ filt command {}<".format(command))
@@ -33,6 +53,9 @@ def demangle(name):
     # will always be ''.
     logging.debug(":processCsv:demangle demangled {}".format(demangled))
     assert len(demangled) == 2
+    demangleCache[name] = demangled[0]
+    if sharedDemangleCache is not None:
+        sharedDemangleCache[name] = demangled[0]
     return demangled[0]
 
 def convertUnits(data, units):
@@ -161,5 +184,300 @@ def processNvprofCSV(csvData, kernelMetrics = dict(), ignoreList = [], verbosePr
 
         logging.debug("Callcount for {0}: {1:5}".format(kernel, count))
 
+    return kernelMetrics
+
+
+def processNvprofLog(logData, kernelMetrics = None):
+    """
+    Processes the output of one or more nvprof runs, ie the logs of all
+    the profiling passes concatenated together. Each "==pid== ... result:"
+    section is processed with processNvprofCSV
+    Returns a dictionary of kernels in the same format as processNvprofCSV
+
+    Positional arguments:
+    logData       -- the nvprof output, a list of lines
+
+    Keyword arguments:
+    kernelMetrics -- existing kernel metrics to append to (default: empty)
+    """
+
+    if kernelMetrics is None:
+        kernelMetrics = dict()
+
+    sectionStarts = [lineNumber for lineNumber, line in enumerate(logData) if "==" in line and "result:" in line]
+    if len(sectionStarts) == 0:
+        raise ValueError("Error, no nvprof results found in log")
+
+    sectionStarts.append(len(logData))
+    for start, end in zip(sectionStarts[:-1], sectionStarts[1:]):
+        # drop any trailing nvprof messages before the next section
+        section = [line for line in logData[start + 1:end] if not line.startswith("==")]
+        processNvprofCSV([logData[start]] + section, kernelMetrics)
+
+    return kernelMetrics
+
+# binary cache layout, all integers are little endian
+# header: magic, version, string/kernel/metric/segment counts and the
+#         offsets of the string table, kernel table, metric table,
+#         segment table and data area
+# string table:  uint32 length followed by utf-8 bytes for each string
+# kernel table:  uint32 name string id, uint32 flags, uint64 call count for each kernel
+# metric table:  uint32 name string id for each metric
+# segment table: uint32 kernel id, uint32 metric id, uint32 kind,
+#                uint64 value count, uint64 byte offset into the data area
+# data area:     one column per metric, the segments of a metric are
+#                stored back to back so each metric is a single float64 column
+#                mixed segments are a float64 column followed by a uint32
+#                string id column
+cacheMagic = b"CRTC"
+cacheVersion = 1
+cacheHeader = struct.Struct("<4sIIIIIQQQQQ")
+cacheKernelEntry = struct.Struct("<IIQ")
+
+# kernel flags, skipped kernels were not replayed for the metric passes
+cacheKernelSkipped = 1
+cacheSegmentEntry = struct.Struct("<IIIQQ")
+
+# segment kinds, numeric data is stored as float64 values
+# anything else (device names etc) is stored as uint32 string ids
+# columns with both (ie empty cells or <OVERFLOW> in a metric) store
+# NaN for the strings and cacheNoString for the numbers
+cacheKindFloat = 0
+cacheKindString = 1
+cacheKindMixed = 2
+cacheNoString = 0xFFFFFFFF
+
+class CachedStringColumn:
+    """
+    Read only list of strings backed by string ids in a memory mapped cache
+    strings are only looked up when they are accessed
+    """
+
+    def __init__(self, ids, strings):
+        self.ids = ids
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.strings[stringId] for stringId in self.ids[index]]
+        return self.strings[self.ids[index]]
+
+    def __iter__(self):
+        for stringId in self.ids:
+            yield self.strings[stringId]
+
+def writeNvprofCache(kernelMetrics, cacheFileName, skippedKernels=None):
+    """
+    Writes a dict of kernel metrics as created by processNvprofCSV to a
+    binary cache file that can be reloaded with loadNvprofCache without
+    parsing the original csv data again
+    Call this once all the passes have been processed, ie after ProfileApp
+
+    Positional arguments:
+    kernelMetrics -- the kernel metrics to write
+    cacheFileName -- the name of the cache file to write
+
+    Keyword arguments:
+    skippedKernels -- kernels skipped during profiling, these are flagged in the cache (default: None)
+    """
+
+    strings = []
+    stringIds = dict()
+
+    def stringId(value):
+        if value not in stringIds:
+            stringIds[value] = len(strings)
+            strings.append(value)
+        return stringIds[value]
+
+    kernels = list(kernelMetrics.keys())
+    if skippedKernels is None:
+        skippedKernels = dict()
+    kernelEntries = [(stringId(kernel), cacheKernelSkipped if kernel in skippedKernels else 0,
+                      kernelMetrics[kernel].get("callCount", 0)) for kernel in kernels]
+
+    # every list valued metric gets a column, callCount is kept in the kernel table
+    metrics = []
+    for kernel in kernels:
+        for metric in kernelMetrics[kernel]:
+            if metric != "callCount" and metric not in metrics:
+                metrics.append(metric)
+    metricEntries = [stringId(metric) for metric in metrics]
+
+    segments = []
+    columns = []
+    dataSize = 0
+    for metricId, metric in enumerate(metrics):
+        for kernelId, kernel in enumerate(kernels):
+            if metric not in kernelMetrics[kernel]:
+                continue
+            values = kernelMetrics[kernel][metric]
+            numeric = [isinstance(value, (float, int)) for value in values]
+            if all(numeric):
+                kind = cacheKindFloat
+                segmentColumns = [array.array('d', values)]
+            elif not any(numeric):
+                kind = cacheKindString
+                segmentColumns = [array.array('I', [stringId(str(value)) for value in values])]
+            else:
+                kind = cacheKindMixed
+                segmentColumns = [array.array('d', [value if isNumber else float("nan")
+                                                    for value, isNumber in zip(values, numeric)]),
+                                  array.array('I', [cacheNoString if isNumber else stringId(str(value))
+                                                    for value, isNumber in zip(values, numeric)])]
+
+            segments.append((kernelId, metricId, kind, len(values), dataSize))
+            for column in segmentColumns:
+                if sys.byteorder != "little":
+                    column.byteswap()
+                columns.append(column)
+                # keep every column 8 byte aligned so it can be used in place
+                dataSize += (len(column) * column.itemsize + 7) & ~7
+
+    encodedStrings = [value.encode("utf-8") for value in strings]
+    stringTableOffset = cacheHeader.size
+    kernelTableOffset = stringTableOffset + sum(4 + len(value) for value in encodedStrings)
+    metricTableOffset = kernelTableOffset + cacheKernelEntry.size * len(kernelEntries)
+    segmentTableOffset = metricTableOffset + 4 * len(metricEntries)
+    dataOffset = (segmentTableOffset + cacheSegmentEntry.size * len(segments) + 7) & ~7
+
+    logging.info("Writing cache {} with {} kernels and {} metrics".format(cacheFileName, len(kernels), len(metrics)))
+    with open(cacheFileName, 'wb') as cacheFile:
+        cacheFile.write(cacheHeader.pack(cacheMagic, cacheVersion, len(strings), len(kernelEntries),
+                                         len(metricEntries), len(segments), stringTableOffset,
+                                         kernelTableOffset, metricTableOffset, segmentTableOffset, dataOffset))
+        for value in encodedStrings:
+            cacheFile.write(struct.pack("<I", len(value)))
+            cacheFile.write(value)
+        for entry in kernelEntries:
+            cacheFile.write(cacheKernelEntry.pack(*entry))
+        for entry in metricEntries:
+            cacheFile.write(struct.pack("<I", entry))
+        for entry in segments:
+            cacheFile.write(cacheSegmentEntry.pack(*entry))
+        cacheFile.write(b"\0" * (dataOffset - cacheFile.tell()))
+        for column in columns:
+            data = column.tobytes()
+            cacheFile.write(data)
+            cacheFile.write(b"\0" * (-len(data) % 8))
+
+def loadNvprofCache(cacheFileName, skippedKernels=None):
+    """
+    Loads a binary cache file written by writeNvprofCache
+    The file is memory mapped and the metric data is not copied, each metric
+    is a read only view into the file which can be passed directly to
+    generateDerivedMetrics and generateRooflinePoints
+    Returns a dictionary of kernels in the same format as processNvprofCSV
+
+    Positional arguments:
+    cacheFileName -- the name of the cache file to load
+
+    Keyword arguments:
+    skippedKernels -- if provided kernels skipped during profiling are added to it
+                      along with their total duration (default: None)
+    """
+
+    with open(cacheFileName, 'rb') as cacheFile:
+        try:
+            cacheData = mmap.mmap(cacheFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("Error loading cache {}, file is empty".format(cacheFileName))
+
+    if len(cacheData) < cacheHeader.size:
+        raise ValueError("Error loading cache {}, file is truncated".format(cacheFileName))
+
+    (magic, version, stringCount, kernelCount, metricCount, segmentCount, stringTableOffset,
+     kernelTableOffset, metricTableOffset, segmentTableOffset, dataOffset) = cacheHeader.unpack_from(cacheData, 0)
+
+    if magic != cacheMagic:
+        raise ValueError("Error loading cache {}, not a cache file".format(cacheFileName))
+    if version != cacheVersion:
+        raise ValueError("Error loading cache {}, unsupported version {}".format(cacheFileName, version))
+
+    def checkBounds(start, size, part):
+        if start + size > len(cacheData):
+            raise ValueError("Error loading cache {}, file is truncated in the {}".format(cacheFileName, part))
+
+    def checkId(itemId, count, part):
+        if itemId >= count:
+            raise ValueError("Error loading cache {}, invalid id {} in the {}".format(cacheFileName, itemId, part))
+
+    strings = []
+    offset = stringTableOffset
+    for _ in range(stringCount):
+        checkBounds(offset, 4, "string table")
+        length, = struct.unpack_from("<I", cacheData, offset)
+        offset += 4
+        checkBounds(offset, length, "string table")
+        strings.append(cacheData[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    checkBounds(kernelTableOffset, kernelCount * cacheKernelEntry.size, "kernel table")
+    checkBounds(metricTableOffset, metricCount * 4, "metric table")
+    checkBounds(segmentTableOffset, segmentCount * cacheSegmentEntry.size, "segment table")
+
+    kernels = []
+    callCounts = []
+    skipped = []
+    kernelMetrics = dict()
+    for kernelId in range(kernelCount):
+        nameId, flags, callCount = cacheKernelEntry.unpack_from(cacheData, kernelTableOffset + kernelId * cacheKernelEntry.size)
+        checkId(nameId, stringCount, "kernel table")
+        kernels.append(strings[nameId])
+        callCounts.append(callCount)
+        if flags & cacheKernelSkipped:
+            skipped.append(strings[nameId])
+        kernelMetrics[strings[nameId]] = {}
+
+    metricIds = struct.unpack_from("<{}I".format(metricCount), cacheData, metricTableOffset)
+    for nameId in metricIds:
+        checkId(nameId, stringCount, "metric table")
+    metrics = [strings[nameId] for nameId in metricIds]
+
+    data = memoryview(cacheData)[dataOffset:]
+    for segment in range(segmentCount):
+        kernelId, metricId, kind, count, offset = cacheSegmentEntry.unpack_from(cacheData,
+                                                    segmentTableOffset + segment * cacheSegmentEntry.size)
+        checkId(kernelId, kernelCount, "segment table")
+        checkId(metricId, metricCount, "segment table")
+        if kind not in [cacheKindFloat, cacheKindString, cacheKindMixed]:
+            raise ValueError("Error loading cache {}, unknown segment kind {}".format(cacheFileName, kind))
+        segmentSize = {cacheKindFloat: 8, cacheKindString: 4, cacheKindMixed: 12}[kind] * count
+        checkBounds(dataOffset + offset, segmentSize, "data area")
+
+        if kind == cacheKindString:
+            segmentColumns = [data[offset:offset + count * 4].cast('I')]
+        else:
+            segmentColumns = [data[offset:offset + count * 8].cast('d')]
+        if kind == cacheKindMixed:
+            segmentColumns.append(data[offset + count * 8:offset + count * 12].cast('I'))
+
+        # the cache is little endian, other systems have to pay for a copy
+        if sys.byteorder != "little":
+            for column, values in enumerate(segmentColumns):
+                segmentColumns[column] = array.array(values.format, values)
+                segmentColumns[column].byteswap()
+
+        if kind == cacheKindFloat:
+            values = segmentColumns[0]
+        elif kind == cacheKindString:
+            values = CachedStringColumn(segmentColumns[0], strings)
+        else:
+            # mixed columns are rare so these are copied into a list
+            values = [value if stringId == cacheNoString else strings[stringId]
+                      for value, stringId in zip(*segmentColumns)]
+        kernelMetrics[kernels[kernelId]][metrics[metricId]] = values
+
+    # call count is always last, same as processNvprofCSV
+    for kernel, callCount in zip(kernels, callCounts):
+        kernelMetrics[kernel]["callCount"] = callCount
+
+    if skippedKernels is not None:
+        for kernel in skipped:
+            skippedKernels[kernel] = sum(kernelMetrics[kernel].get("Duration", []))
 
+    logging.info("Loaded cache {} with {} kernels and {} metrics".format(cacheFileName, kernelCount, metricCount))
     return kernelMetrics
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import time
+import socket
+import stat
+import hashlib
+import logging
+import tempfile
+import threading
+import shutil
+import collections
+import statistics
+import socketserver
+import http.client
+import http.server
+import multiprocessing
+import concurrent.futures
+import urllib.parse
+
+import processCsvData
+from processCsvData import *
+from collectNvprof import *
+
+# jobs are kept in memory, parsed profiles are kept as binary
+# cache files (see writeNvprofCache) in the cache directory so
+# every worker can reuse them
+jobStatusPending = "pending"
+jobStatusDone = "done"
+jobStatusError = "error"
+
+# uploads are streamed to disk in chunks of this size
+uploadChunkSize = 1 << 20
+
+# nvprof --export-profile writes sqlite databases (.nvvp), these aren't parsed
+sqliteMagic = b"SQLite format 3\0"
+
+def parseAddress(address):
+    """
+    Parses a service address, either unix:<socket path>, <host>:<port> or <port>
+    Returns a tuple of the socket family and the address for that family
+    """
+
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+
+    host, _, port = address.rpartition(":")
+    if host == "":
+        host = "localhost"
+    return socket.AF_INET, (host, int(port))
+
+def checkProfileFormat(profileFileName):
+    """
+    Checks that an upload is a format analyzeProfile can parse, either an
+    nvprof --csv log or a binary cache file, and raises ValueError if not
+    Only the start of the file is looked at, logs without results are
+    reported when they're parsed
+    """
+
+    with open(profileFileName, 'rb') as profileFile:
+        profileData = profileFile.read(uploadChunkSize)
+
+    if profileData.startswith(cacheMagic):
+        return
+    if profileData.startswith(sqliteMagic):
+        raise ValueError("nvvp files from nvprof --export-profile aren't supported, "
+                         "submit the nvprof --csv log or a cache file from collectNvprof.py --cache")
+    if b"\0" in profileData:
+        raise ValueError("the profile must be an nvprof --csv log or a cache file from collectNvprof.py --cache")
+
+def initWorker(sharedDemangleCache):
+    """
+    Runs in each worker process, lets demangle fall back to the cache shared by all workers
+    """
+    processCsvData.sharedDemangleCache = sharedDemangleCache
+
+def analyzeProfile(profileFileName, profileHash, modelName, cacheDir):
+    """
+    Parses and analyzes an uploaded profile, runs in a worker process
+    The profile is either nvprof csv output (one or more passes) or a binary
+    cache file. Parsed profiles are cached in cacheDir by their contents hash
+    The uploaded file is removed once it has been parsed
+    Returns a dict with the kernels, roofline points and aspen model
+    """
+
+    cacheFileName = os.path.join(cacheDir, profileHash + ".crtc")
+
+    try:
+        if not os.path.exists(cacheFileName):
+            with open(profileFileName, 'rb') as profileFile:
+                magic = profileFile.read(len(cacheMagic))
+
+            if magic == cacheMagic:
+                # already a cache, the upload can be used as is
+                os.replace(profileFileName, cacheFileName)
+            else:
+                # write to a temporary file first so other workers never see a partial cache
+                tempFileName = "{}.{}.tmp".format(cacheFileName, os.getpid())
+                try:
+                    with open(profileFileName, 'r') as profileFile:
+                        writeNvprofCache(processNvprofLog(profileFile.read().splitlines()), tempFileName)
+                    os.replace(tempFileName, cacheFileName)
+                except BaseException:
+                    if os.path.exists(tempFileName):
+                        os.remove(tempFileName)
+                    raise
+        else:
+            logging.info("Using cached profile {}".format(cacheFileName))
+    finally:
+        if os.path.exists(profileFileName):
+            os.remove(profileFileName)
+
+    skippedKernels = dict()
+    kernelMetrics = loadNvprofCache(cacheFileName, skippedKernels)
+
+    generateDerivedMetrics(kernelMetrics, statistics, throughputMetrics, countMetrics, combinedMetrics)
+    rooflines, memRooflines = generateRooflinePoints(kernelMetrics)
+
+    with tempfile.TemporaryDirectory() as outputDir:
+        generateAspenModel(kernelMetrics, modelName, rooflines, skippedKernels, outputDir)
+        with open(os.path.join(outputDir, modelName + ".aspen"), 'r') as aspenFile:
+            aspenModel = aspenFile.read()
+
+    return {"kernels": list(kernelMetrics.keys()),
+            "rooflines": rooflines,
+            "memRooflines": memRooflines,
+            "skippedKernels": skippedKernels,
+            "aspen": aspenModel}
+
+class ProfileService:
+    """
+    Keeps track of submitted profiles and analyzes them in a process pool
+    Once maxPending profiles are being uploaded or waiting new submissions
+    are refused. Only the last maxFinished finished profiles are kept
+    """
+
+    def __init__(self, workers=None, maxPending=16, cacheDir=None, maxFinished=256):
+        # a temporary cache directory is removed on shutdown
+        self.removeCacheDir = cacheDir is None
+        if cacheDir is None:
+            cacheDir = tempfile.mkdtemp(prefix="rooflineCache")
+        os.makedirs(cacheDir, exist_ok=True)
+
+        self.cacheDir = cacheDir
+        self.maxPending = maxPending
+        self.maxFinished = maxFinished
+        self.jobs = dict()
+        self.finished = collections.OrderedDict()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.manager = multiprocessing.Manager()
+        self.demangleCache = self.manager.dict()
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                                                           initargs=(self.demangleCache,))
+
+    def reserve(self):
+        """
+        Reserves a slot for a profile before it is uploaded
+        Returns False if the service is overloaded
+        """
+
+        with self.lock:
+            if self.pending >= self.maxPending:
+                logging.info("{} profiles pending, refusing upload".format(self.pending))
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        """
+        Releases a reserved slot that wasn't used for a job
+        """
+
+        with self.lock:
+            self.pending -= 1
+
+    def submit(self, profileFileName, profileHash, modelName):
+        """
+        Submits an uploaded profile for analysis using a slot from reserve
+        The service takes over the uploaded file, the same profile and name is
+        only analyzed once
+        Returns the job
+        """
+
+        jobId = hashlib.sha256("{}\0{}".format(modelName, profileHash).encode()).hexdigest()
+
+        with self.lock:
+            if jobId in self.jobs and self.jobs[jobId]["status"] != jobStatusError:
+                self.pending -= 1
+                os.remove(profileFileName)
+                return dict(self.jobs[jobId])
+
+            job = {"id": jobId, "name": modelName, "status": jobStatusPending}
+            self.jobs[jobId] = job
+            self.finished.pop(jobId, None)
+
+        future = self.pool.submit(analyzeProfile, profileFileName, profileHash, modelName, self.cacheDir)
+        future.add_done_callback(lambda future: self.finish(job, future))
+        return dict(job)
+
+    def finish(self, job, future):
+        with self.lock:
+            self.pending -= 1
+            try:
+                job["result"] = future.result()
+                job["status"] = jobStatusDone
+            except Exception as error:
+                logging.error("Error analyzing {}: {}".format(job["name"], error))
+                job["error"] = "{}: {}".format(type(error).__name__, error)
+                job["status"] = jobStatusError
+
+            # forget the oldest finished jobs
+            self.finished[job["id"]] = None
+            while len(self.finished) > self.maxFinished:
+                oldJobId, _ = self.finished.popitem(last=False)
+                del self.jobs[oldJobId]
+
+    def getJob(self, jobId):
+        with self.lock:
+            if jobId not in self.jobs:
+                return None
+            return dict(self.jobs[jobId])
+
+    def listJobs(self):
+        with self.lock:
+            return [{"id": job["id"], "name": job["name"], "status": job["status"]} for job in self.jobs.values()]
+
+    def shutdown(self):
+        self.pool.shutdown()
+        self.manager.shutdown()
+        if self.removeCacheDir:
+            shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+class ProfileRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /profiles?name=<model name>   submit a profile, the body is the profile
+    GET  /profiles                     list all profiles
+    GET  /profiles/<id>                status and results of a profile
+    GET  /profiles/<id>/aspen          the aspen model of a profile
+    """
+
+    def sendData(self, status, data, contentType="application/json", headers={}):
+        if contentType == "application/json":
+            data = json.dumps(data)
+        data = data.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        for header in headers:
+            self.send_header(header, headers[header])
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/profiles":
+            self.sendData(404, {"error": "unknown path {}".format(url.path)})
+            return
+
+        modelName = urllib.parse.parse_qs(url.query).get("name", ["profile"])[0]
+        modelName = os.path.basename(modelName)
+        if modelName == "":
+            self.sendData(400, {"error": "the model name can't be blank"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length <= 0:
+            # the body can't be read reliably so the connection is closed
+            self.close_connection = True
+            self.sendData(400, {"error": "Content-Length must be a positive number of bytes, got {}".format(
+                          self.headers.get("Content-Length"))}, headers={"Connection": "close"})
+            return
+
+        # refuse before reading anything so an overloaded service
+        # doesn't have to hold on to the profile
+        if not self.server.service.reserve():
+            self.close_connection = True
+            self.sendData(503, {"error": "too many profiles pending"},
+                          headers={"Retry-After": "1", "Connection": "close"})
+            return
+
+        try:
+            profileFileName, profileHash = self.readUpload(length)
+        except ConnectionError as error:
+            logging.info("Upload of {} failed: {}".format(modelName, error))
+            self.server.service.release()
+            self.close_connection = True
+            return
+
+        try:
+            checkProfileFormat(profileFileName)
+        except ValueError as error:
+            os.remove(profileFileName)
+            self.server.service.release()
+            self.sendData(400, {"error": str(error)})
+            return
+
+        job = self.server.service.submit(profileFileName, profileHash, modelName)
+        if job["status"] == jobStatusPending:
+            self.sendData(202, job)
+        else:
+            self.sendData(200, job)
+
+    def readUpload(self, length):
+        """
+        Streams the request body to a file in the cache directory
+        Returns the file name and the sha256 hash of its contents
+        """
+
+        profileHash = hashlib.sha256()
+        fileDescriptor, profileFileName = tempfile.mkstemp(prefix="upload", suffix=".tmp",
+                                                           dir=self.server.service.cacheDir)
+        try:
+            with os.fdopen(fileDescriptor, 'wb') as profileFile:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, uploadChunkSize))
+                    if len(chunk) == 0:
+                        raise ConnectionError("connection closed with {} bytes left".format(remaining))
+                    profileHash.update(chunk)
+                    profileFile.write(chunk)
+                    remaining -= len(chunk)
+        except BaseException:
+            os.remove(profileFileName)
+            raise
+
+        return profileFileName, profileHash.hexdigest()
+
+    def do_GET(self):
+        parts = [part for part in urllib.parse.urlparse(self.path).path.split("/") if part != ""]
+
+        if parts == ["profiles"]:
+            self.sendData(200, self.server.service.listJobs())
+            return
+
+        if len(parts) not in [2, 3] or parts[0] != "profiles" or (len(parts) == 3 and parts[2] != "aspen"):
+            self.sendData(404, {"error": "unknown path {}".format(self.path)})
+            return
+
+        job = self.server.service.getJob(parts[1])
+        if job is None:
+            self.sendData(404, {"error": "unknown profile {}".format(parts[1])})
+        elif len(parts) == 2:
+            self.sendData(200, job)
+        elif job["status"] != jobStatusDone:
+            self.sendData(409, {"error": "profile {} is {}".format(parts[1], job["status"])})
+        else:
+            self.sendData(200, job["result"]["aspen"], contentType="text/plain")
+
+    def log_message(self, format, *args):
+        # unix sockets don't have a client address
+        logging.debug(format % args)
+
+class ProfileHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+class ProfileUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def startServer(address, service):
+    """
+    Starts serving the given service on address (see parseAddress)
+    Returns the server, call serve_forever to handle requests
+    """
+
+    family, socketAddress = parseAddress(address)
+    if family == socket.AF_UNIX:
+        # remove a socket left behind by a previous run
+        if os.path.exists(socketAddress) and stat.S_ISSOCK(os.stat(socketAddress).st_mode):
+            os.unlink(socketAddress)
+        server = ProfileUnixServer(socketAddress, ProfileRequestHandler)
+    else:
+        server = ProfileHTTPServer(socketAddress, ProfileRequestHandler)
+
+    server.service = service
+    logging.info("Profile service listening on {}".format(address))
+    return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socketPath, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+def request(address, method, path, body=None, headers={}):
+    """
+    Makes a request to the service
+    Returns the status, headers and body of the response
+    """
+
+    family, socketAddress = parseAddress(address)
+    if family == socket.AF_UNIX:
+        connection = UnixHTTPConnection(socketAddress)
+    else:
+        connection = http.client.HTTPConnection(*socketAddress, timeout=60)
+
+    try:
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        connection.close()
+
+def submitProfile(address, profileData, modelName, retries=10, pollInterval=0.1, timeout=3600):
+    """
+    Submits a profile to the service and waits for it to be analyzed
+    The profile is either bytes or a binary file, files are streamed
+    Backs off and retries while the service is overloaded
+    Raises RuntimeError if the profile isn't analyzed within timeout seconds,
+    or if the service no longer knows about it (ie it was restarted)
+    Returns the results, see analyzeProfile
+    """
+
+    deadline = time.monotonic() + timeout
+
+    if hasattr(profileData, "read"):
+        length = os.fstat(profileData.fileno()).st_size
+    else:
+        length = len(profileData)
+
+    path = "/profiles?" + urllib.parse.urlencode({"name": modelName})
+    for attempt in range(retries):
+        if hasattr(profileData, "seek"):
+            profileData.seek(0)
+        try:
+            status, headers, body = request(address, "POST", path, profileData,
+                                            {"Content-Length": str(length)})
+        except (ConnectionResetError, BrokenPipeError):
+            # a busy service closes the connection without reading the profile
+            # so the 503 may be lost while the profile is still being sent
+            status, headers, body = 503, {}, b""
+        if status != 503 or attempt == retries - 1:
+            break
+        delay = float(headers.get("Retry-After", 1)) * (attempt + 1)
+        if time.monotonic() + delay > deadline:
+            break
+        logging.info("Profile service busy, retrying in {} s".format(delay))
+        time.sleep(delay)
+
+    if status not in [200, 202]:
+        raise RuntimeError("Error submitting {}, status {}: {}".format(modelName, status, body.decode()))
+
+    job = json.loads(body)
+    while job["status"] == jobStatusPending:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Error analyzing {}, no result after {} s".format(modelName, timeout))
+        time.sleep(pollInterval)
+        status, headers, body = request(address, "GET", "/profiles/" + job["id"])
+        if status != 200:
+            raise RuntimeError("Error waiting for {}, status {}: {}".format(modelName, status, body.decode()))
+        job = json.loads(body)
+
+    if job["status"] == jobStatusError:
+        raise RuntimeError("Error analyzing {}: {}".format(modelName, job["error"]))
+
+    return job["result"]
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    usage = ("Correct usage {0} [--workers <count>] [--max-pending <count>] [--max-finished <count>] "
+             "[--cache-dir <directory>] <unix:socket path | [host:]port>\n"
+             "  profiles are posted to /profiles?name=<model name> as an nvprof --csv log\n"
+             "  or a cache file from collectNvprof.py --cache, nvvp exports aren't supported".format(sys.argv[0]))
+
+    workers = None
+    maxPending = 16
+    maxFinished = 256
+    cacheDir = None
+    args = sys.argv[1:]
+    while len(args) > 0 and args[0] in ["--workers", "--max-pending", "--max-finished", "--cache-dir"]:
+        if len(args) < 2:
+            print(usage)
+            exit(0)
+        if args[0] == "--workers":
+            workers = int(args[1])
+        elif args[0] == "--max-pending":
+            maxPending = int(args[1])
+        elif args[0] == "--max-finished":
+            maxFinished = int(args[1])
+        else:
+            cacheDir = args[1]
+        args = args[2:]
+
+    if len(args) != 1:
+        print(usage)
+        exit(0)
+
+    service = ProfileService(workers, maxPending, cacheDir, maxFinished)
+    server = startServer(args[0], service)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from collectNvprof import selectKernels
+
+
+# total GPU time: big 6, mid 3, small 0.9, tiny 0.1, memcpy is a library call
+kernelMetrics = {"big(float*)":        {"Duration": [3.0, 3.0], "callCount": 2},
+                 "mid(float*)":        {"Duration": [3.0], "callCount": 1},
+                 "small(int)":         {"Duration": [0.45, 0.45], "callCount": 2},
+                 "tiny(int)":          {"Duration": [0.1], "callCount": 1},
+                 "[CUDA memcpy HtoD]": {"Duration": [5.0], "callCount": 1}}
+
+
+def test_select_by_coverage():
+    selected, skipped = selectKernels(kernelMetrics, coverage=0.9)
+    assert selected == ["big(float*)", "mid(float*)"]
+    assert skipped == {"small(int)": 0.9, "tiny(int)": 0.1}
+
+    selected, skipped = selectKernels(kernelMetrics, coverage=0.95)
+    assert selected == ["big(float*)", "mid(float*)", "small(int)"]
+    assert skipped == {"tiny(int)": 0.1}
+
+    selected, skipped = selectKernels(kernelMetrics, coverage=1.0)
+    assert selected == ["big(float*)", "mid(float*)", "small(int)", "tiny(int)"]
+    assert skipped == {}
+
+
+def test_select_by_time_budget():
+    # mid doesn't fit but the smaller kernels do
+    selected, skipped = selectKernels(kernelMetrics, timeBudget=7.5)
+    assert selected == ["big(float*)", "small(int)", "tiny(int)"]
+    assert list(skipped) == ["mid(float*)"]
+
+    # the longest kernel is always selected, even over budget
+    selected, skipped = selectKernels(kernelMetrics, timeBudget=1.0)
+    assert selected == ["big(float*)"]
+    assert set(skipped) == {"mid(float*)", "small(int)", "tiny(int)"}
+
+
+def test_select_by_coverage_and_time_budget():
+    # coverage isn't reached, the budget still lets the tiny kernel in
+    selected, skipped = selectKernels(kernelMetrics, coverage=0.95, timeBudget=6.5)
+    assert selected == ["big(float*)", "tiny(int)"]
+    assert set(skipped) == {"mid(float*)", "small(int)"}
+
+
+def test_select_only_library_calls():
+    selected, skipped = selectKernels({"[CUDA memcpy HtoD]": {"Duration": [5.0], "callCount": 1}}, coverage=0.95)
+    assert selected == []
+    assert skipped == {}
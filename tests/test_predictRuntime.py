@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from predictRuntime import *
+
+
+template = """
+mem_bw(x) = x < 10 ? x * 100 : 1/0
+dp_simd_fmad_flops(x) = x > 10 ? 1000 : 1/0
+plot mem_bw(x) with lines linewidth 2 ti "memory bw" noenhanced
+"""
+
+
+def test_predict_runtimes(tmp_path):
+    templateFileName = tmp_path / "tiny_gpu.aspen"
+    templateFileName.write_text(template)
+    machines = loadMachines([str(templateFileName)])
+
+    assert machines == {"tiny_gpu": {"mem_bw": 100.0e9, "dp_simd_fmad_flops": 1000.0e9}}
+
+    # memory bound: 1e9 bytes at 100 GB/s, flops only take 2 ms
+    # flops bound: 4e12 flops at 1 TFLOPS, bytes only take 10 ms
+    kernelMetrics = {"memoryBound(float*)": {"Duration": [0.01, 0.01],
+                                             "flop_count_dp": [2.0e9, 2.0e9],
+                                             "dram_bytes": [1.0e9, 1.0e9],
+                                             "callCount": 2},
+                     "flopsBound(float*)": {"Duration": [3.0],
+                                            "flop_count_dp": [4.0e12],
+                                            "dram_bytes": [1.0e9],
+                                            "callCount": 1},
+                     "[CUDA memcpy HtoD]": {"Duration": [0.5],
+                                            "callCount": 1}}
+
+    kernelPredictions, appPredictions, unmodeledKernels = predictRuntimes(kernelMetrics, machines)
+
+    timePerCall, totalTime, bound = kernelPredictions["tiny_gpu"]["memoryBound(float*)"]
+    assert timePerCall == pytest.approx(0.01)
+    assert totalTime == pytest.approx(0.02)
+    assert bound == "dram_bytes"
+
+    timePerCall, totalTime, bound = kernelPredictions["tiny_gpu"]["flopsBound(float*)"]
+    assert timePerCall == pytest.approx(4.0)
+    assert totalTime == pytest.approx(4.0)
+    assert bound == "flop_count_dp"
+
+    assert appPredictions["tiny_gpu"] == pytest.approx(4.02)
+    assert "[CUDA memcpy HtoD]" not in kernelPredictions["tiny_gpu"]
+    assert unmodeledKernels == {"[CUDA memcpy HtoD]": 0.5}
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from processCsvData import *
+
+
+def loaded_as_lists(kernelMetrics):
+    return {kernel: {metric: values if metric == "callCount" else list(values)
+                     for metric, values in metrics.items()}
+            for kernel, metrics in kernelMetrics.items()}
+
+
+def test_cache_round_trip(tmp_path):
+    kernelMetrics = {"big(float*)": {"Duration": [1.0e-3, 2.0e-3],
+                                     "Device": ["Tesla (0)", "Tesla (0)"],
+                                     "Grid X": [4.0, ""],
+                                     "dram_read_throughput": ["<OVERFLOW>", 2.5e9],
+                                     "callCount": 2},
+                     "tiny(int)": {"Duration": [1.0e-5],
+                                   "Device": ["Tesla (0)"],
+                                   "callCount": 1}}
+    skippedKernels = {"tiny(int)": 1.0e-5}
+    cacheFileName = str(tmp_path / "profile.crtc")
+
+    writeNvprofCache(kernelMetrics, cacheFileName, skippedKernels)
+    loadedSkipped = dict()
+    loaded = loadNvprofCache(cacheFileName, loadedSkipped)
+
+    assert loaded_as_lists(loaded) == kernelMetrics
+    assert loadedSkipped == skippedKernels
+    # numbers in mixed columns stay numbers
+    assert loaded["big(float*)"]["Grid X"][0] == 4.0
+    assert isinstance(loaded["big(float*)"]["dram_read_throughput"][1], float)
+
+
+def test_truncated_cache(tmp_path):
+    kernelMetrics = {"big(float*)": {"Duration": [1.0e-3, 2.0e-3], "Grid X": [4.0, ""], "callCount": 2}}
+    cacheFileName = str(tmp_path / "profile.crtc")
+    writeNvprofCache(kernelMetrics, cacheFileName)
+
+    with open(cacheFileName, 'rb') as cacheFile:
+        cacheData = cacheFile.read()
+
+    truncatedFileName = str(tmp_path / "truncated.crtc")
+    for cut in [1, 8, 100, len(cacheData) - cacheHeader.size]:
+        with open(truncatedFileName, 'wb') as cacheFile:
+            cacheFile.write(cacheData[:-cut])
+        with pytest.raises(ValueError):
+            loadNvprofCache(truncatedFileName)
@@ -0,0 +1,138 @@
+import os
+import sys
+import shutil
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from profileService import *
+
+synthetic_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "synthetic_nvprof.log")
+
+pytestmark = pytest.mark.skipif(shutil.which("c++filt") is None, reason="c++filt is needed to demangle")
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def service(request, tmp_path):
+    service = ProfileService(workers=1, maxPending=1, cacheDir=str(tmp_path / "cache"))
+    if request.param == "tcp":
+        server = startServer("127.0.0.1:0", service)
+        address = "127.0.0.1:{}".format(server.server_address[1])
+    else:
+        address = "unix:" + str(tmp_path / "sock")
+        server = startServer(address, service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield service, address
+
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+
+def test_submit_synthetic_log(service):
+    service, address = service
+
+    with open(synthetic_log, 'rb') as profileFile:
+        result = submitProfile(address, profileFile, "synthetic")
+
+    assert "big(float*)" in result["kernels"]
+    assert "[CUDA memcpy HtoD]" in result["kernels"]
+    assert any(roofline.endswith("/big(float*)") for roofline in result["rooflines"])
+    assert "model synthetic {" in result["aspen"]
+
+    # the same profile again is answered from the finished job
+    with open(synthetic_log, 'rb') as profileFile:
+        assert submitProfile(address, profileFile, "synthetic") == result
+
+    status, headers, body = request(address, "GET", "/profiles")
+    assert status == 200
+    assert [job["status"] for job in json.loads(body)] == [jobStatusDone]
+
+    # no uploads are left behind, only the parsed profile
+    assert [name for name in os.listdir(service.cacheDir) if not name.endswith(".crtc")] == []
+
+
+def test_busy_service_refuses_uploads(service):
+    service, address = service
+
+    with open(synthetic_log, 'rb') as profileFile:
+        profileData = profileFile.read()
+
+    # take the only slot, the upload is refused without being read
+    assert service.reserve()
+    try:
+        status, headers, body = request(address, "POST", "/profiles?name=busy", profileData)
+        assert status == 503
+        assert headers["Retry-After"] == "1"
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+
+    with pytest.raises(RuntimeError):
+        submitProfile(address, profileData, "busy", retries=1)
+
+    service.release()
+    assert "big(float*)" in submitProfile(address, profileData, "busy")["kernels"]
+
+
+def test_bad_profile_reports_error(service):
+    service, address = service
+
+    with pytest.raises(RuntimeError, match="no nvprof results"):
+        submitProfile(address, b"not a profile\n", "bad")
+
+
+@pytest.mark.parametrize("contentLength", ["abc", "-5", "0"])
+def test_bad_content_length(service, contentLength):
+    service, address = service
+
+    family, socketAddress = parseAddress(address)
+    if family == socket.AF_UNIX:
+        connection = UnixHTTPConnection(socketAddress)
+    else:
+        connection = http.client.HTTPConnection(*socketAddress)
+    connection.putrequest("POST", "/profiles?name=bad")
+    connection.putheader("Content-Length", contentLength)
+    connection.endheaders()
+    response = connection.getresponse()
+    connection.close()
+
+    assert response.status == 400
+    assert service.pending == 0
+
+
+def test_submit_gives_up(service, monkeypatch):
+    service, address = service
+
+    with open(synthetic_log, 'rb') as profileFile:
+        profileData = profileFile.read()
+
+    # a job that never finishes hits the deadline
+    monkeypatch.setattr(service.pool, "submit", lambda *args: concurrent.futures.Future())
+    with pytest.raises(RuntimeError, match="no result after"):
+        submitProfile(address, profileData, "hung", timeout=0.5)
+
+    # a job the service forgot about, ie after a restart, is an error
+    service.release()
+    def forgetJob(profileFileName, profileHash, modelName):
+        service.release()
+        os.remove(profileFileName)
+        return {"id": "forgotten", "name": modelName, "status": jobStatusPending}
+    monkeypatch.setattr(service, "submit", forgetJob)
+    with pytest.raises(RuntimeError, match="status 404"):
+        submitProfile(address, profileData, "forgotten", timeout=0.5)
+
+
+@pytest.mark.parametrize("profileData, message", [(b"SQLite format 3\0" + bytes(100), "nvvp"),
+                                                  (bytes(range(256)), "nvprof --csv log")])
+def test_unsupported_format(service, profileData, message):
+    service, address = service
+
+    status, headers, body = request(address, "POST", "/profiles?name=unsupported", profileData)
+    assert status == 400
+    assert message in json.loads(body)["error"]
+    assert service.pending == 0
+    assert os.listdir(service.cacheDir) == []